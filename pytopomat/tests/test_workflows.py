@@ -0,0 +1,49 @@
+import unittest
+
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+from pytopomat.workflows.core import Z2PackWF
+
+
+class Z2PackWFTest(unittest.TestCase):
+    def assertEquivPlanes(self, structure, expected):
+        equiv_planes = Z2PackWF(structure).get_equiv_planes()
+
+        self.assertEqual(set(equiv_planes.keys()), set(expected.keys()))
+        for plane, equiv in expected.items():
+            self.assertCountEqual(equiv_planes[plane], equiv, msg=plane)
+
+    def test_get_equiv_planes_cubic(self):
+        structure = Structure(Lattice.cubic(3.35), ["Po"], [[0, 0, 0]])
+
+        self.assertEquivPlanes(
+            structure,
+            {
+                "kx_0": ["ky_0", "kz_0"],
+                "kx_1": ["ky_1", "kz_1"],
+                "ky_0": ["kx_0", "kz_0"],
+                "ky_1": ["kx_1", "kz_1"],
+                "kz_0": ["kx_0", "ky_0"],
+                "kz_1": ["kx_1", "ky_1"],
+            },
+        )
+
+    def test_get_equiv_planes_tetragonal(self):
+        structure = Structure(Lattice.tetragonal(3.0, 5.0), ["Sn"], [[0, 0, 0]])
+
+        self.assertEquivPlanes(
+            structure,
+            {
+                "kx_0": ["ky_0"],
+                "kx_1": ["ky_1"],
+                "ky_0": ["kx_0"],
+                "ky_1": ["kx_1"],
+                "kz_0": [],
+                "kz_1": [],
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import numpy as np
 import itertools
 
+from collections import defaultdict
+from functools import lru_cache
 from uuid import uuid4
 
 from pymatgen.io.vasp.inputs import Kpoints
@@ -37,6 +39,17 @@ __email__ = "jmunro@lbl.gov, ncfrey@lbl.gov"
 __status__ = "Development"
 __date__ = "August 2019"
 
+# TRIM planes in the BZ, e.g. "kx_0" is k_x = 0 and "kx_1" is k_x = 1/2
+TRIM_PLANE_NAMES = ["kx_0", "kx_1", "ky_0", "ky_1", "kz_0", "kz_1"]
+# The 4 TRIM points in each plane, in fractional reciprocal coords: (6, 4, 3)
+TRIM_PLANES = np.array(
+    [
+        [pt for pt in itertools.product((0.0, 0.5), repeat=3) if pt[coord] == k]
+        for coord in range(3)
+        for k in (0.0, 0.5)
+    ]
+)
+
 
 def wf_vasp2trace_nonmagnetic(structure, c=None):
     """
@@ -55,10 +68,7 @@ def wf_vasp2trace_nonmagnetic(structure, c=None):
 
     ncoords = 3 * len(structure.sites)
 
-    nbands = 0
-
-    for site in structure.sites:
-        nbands += site.species.total_electrons
+    nbands = int(round(structure.composition.total_electrons))
 
     trim_kpoints = Kpoints(
         comment="TRIM Points",
@@ -100,52 +110,37 @@ def wf_vasp2trace_nonmagnetic(structure, c=None):
         common_params={"vasp_cmd": vasp_cmd, "db_file": db_file},
     )
 
+    # Collect INCAR updates per fw_name_constraint and apply each set once
+    incar_updates = defaultdict(dict)
+    incar_updates["structure optimization"].update(
+        {"EDIFFG": 0.005, "IBRION": 2, "NSW": 100}
+    )
+
     dim_data = StructureDimensionality(structure)
 
-    if np.any(
-        [
-            dim == 2
-            for dim in [dim_data.larsen_dim, dim_data.cheon_dim, dim_data.gorai_dim]
-        ]
-    ):
-        wf = add_modify_incar(
-            wf,
-            modify_incar_params={
-                "incar_update": {"IVDW": 11, "EDIFFG": 0.005, "IBRION": 2, "NSW": 100}
-            },
-            fw_name_constraint="structure optimization",
-        )
-    else:
-        wf = add_modify_incar(
-            wf,
-            modify_incar_params={
-                "incar_update": {"EDIFFG": 0.005, "IBRION": 2, "NSW": 100}
-            },
-            fw_name_constraint="structure optimization",
-        )
+    if 2 in (dim_data.larsen_dim, dim_data.cheon_dim, dim_data.gorai_dim):
+        incar_updates["structure optimization"]["IVDW"] = 11
 
-    wf = add_modify_incar(
-        wf,
-        modify_incar_params={
-            "incar_update": {"ADDGRID": ".TRUE.", "LASPH": ".TRUE.", "GGA": "PS"}
-        },
-    )
+    incar_updates[None].update({"ADDGRID": ".TRUE.", "LASPH": ".TRUE.", "GGA": "PS"})
 
-    wf = add_modify_incar(
-        wf,
-        modify_incar_params={
-            "incar_update": {
-                "ISYM": 2,
-                "LSORBIT": ".TRUE.",
-                "MAGMOM": "%i*0.0" % ncoords,
-                "ISPIN": 1,
-                "LWAVE": ".TRUE.",
-                "NBANDS": nbands,
-            }
-        },
-        fw_name_constraint="nscf",
+    incar_updates["nscf"].update(
+        {
+            "ISYM": 2,
+            "LSORBIT": ".TRUE.",
+            "MAGMOM": "%i*0.0" % ncoords,
+            "ISPIN": 1,
+            "LWAVE": ".TRUE.",
+            "NBANDS": nbands,
+        }
     )
 
+    for fw_name_constraint, incar_update in incar_updates.items():
+        wf = add_modify_incar(
+            wf,
+            modify_incar_params={"incar_update": incar_update},
+            fw_name_constraint=fw_name_constraint,
+        )
+
     wf = add_common_powerups(wf, c)
 
     if c.get("STABILITY_CHECK", STABILITY_CHECK):
@@ -157,6 +152,43 @@ def wf_vasp2trace_nonmagnetic(structure, c=None):
     return wf
 
 
+class _StructureKey:
+    def __init__(self, structure):
+        """
+        Hashable wrapper of a structure, used to memoize symmetry analysis across 
+        workflows built for the same structure. Hashes and compares on the 
+        lattice, the species and occupancies of each site (so disordered 
+        structures work), the fractional coordinates and any magmoms, which is 
+        everything SpacegroupAnalyzer depends on. Results are computed from 
+        the wrapped structure itself.
+
+        Args:
+          structure (Structure): Pymatgen structure object
+
+        """
+        self.structure = structure
+
+        magmoms = structure.site_properties.get("magmom")
+        if magmoms is not None:
+            magmoms = tuple(tuple(np.ravel(m).astype(float)) for m in magmoms)
+
+        self.key = (
+            np.ascontiguousarray(structure.lattice.matrix, dtype=float).tobytes(),
+            tuple(
+                tuple(sorted((str(sp), occu) for sp, occu in site.species.items()))
+                for site in structure
+            ),
+            np.ascontiguousarray(structure.frac_coords, dtype=float).tobytes(),
+            magmoms,
+        )
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, _StructureKey) and self.key == other.key
+
+
 class Z2PackWF:
     def __init__(self, structure, symmetry_reduction=True, vasp_cmd=VASP_CMD, db_file=DB_FILE):
         """
@@ -186,60 +218,81 @@ class Z2PackWF:
           fractional reciprocal space basis. 
 
         """
+        return list(Z2PackWF._cached_reciprocal_point_group(_StructureKey(struct)))
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _cached_reciprocal_point_group(struct_key):
+        """
+        Reciprocal point group of struct_key.structure, cached per fingerprint.
+
+        Args:
+          struct_key (_StructureKey): Hashable wrapper of the input structure.
+
+        Returns:
+          recip_point_group (tuple): Symmetry operations as numpy arrays in the 
+          fractional reciprocal space basis.
+
+        """
+        struct = struct_key.structure
+
         R = -1 * np.eye(3)
         sga = SpacegroupAnalyzer(struct)
         ops = sga.get_symmetry_operations()
-        isomorphic_point_group = [op.rotation_matrix for op in ops]
-
-        V = struct.lattice.matrix.T  # fractional real space to cartesian real space
-        # fractional reciprocal space to cartesian reciprocal space
-        W = struct.lattice.reciprocal_lattice.matrix.T
-        # fractional real space to fractional reciprocal space
-        A = np.dot(np.linalg.inv(W), V)
-
-        Ainv = np.linalg.inv(A)
-        # convert to reciprocal primitive basis
-        recip_point_group = [np.around(np.dot(A, np.dot(R, Ainv)), decimals=2)]
-        for op in isomorphic_point_group:
-            op = np.around(np.dot(A, np.dot(op, Ainv)), decimals=2)
-            new = True
-            new_coset = True
-            for thing in recip_point_group:
-                if (thing == op).all():
-                    new = False
-                if (thing == np.dot(R, op)).all():
-                    new_coset = False
-
-            if new:
+        isomorphic_point_group = np.stack([op.rotation_matrix for op in ops])
+
+        # Fractional real space to fractional reciprocal space is A = W^-1 V, with
+        # V = L^T (fractional real -> cartesian real) and W = 2 pi L^-1
+        # (fractional reciprocal -> cartesian reciprocal), i.e. the metric
+        # tensor L L^T / (2 pi). Its inverse follows from the cached L^-1.
+        Linv = struct.lattice.inv_matrix
+        A = struct.lattice.metric_tensor / (2 * np.pi)
+        Ainv = 2 * np.pi * np.dot(Linv.T, Linv)
+        # convert all ops to reciprocal primitive basis at once
+        transformed = A @ isomorphic_point_group @ Ainv
+        transformed = np.around(transformed, decimals=2)
+        cosets = R @ transformed
+
+        # interleave each op with its coset so both are checked in one pass;
+        # an op never equals its own coset, so the order of checks is safe
+        candidates = np.stack([transformed, cosets], axis=1).reshape(-1, 3, 3)
+
+        # Compare ops by their entries in units of 0.01 as integers, which is
+        # exact and makes -0.0 and 0.0 the same key
+        keys = np.rint(candidates * 100).astype(np.int32)
+
+        inversion = np.around(np.dot(A, np.dot(R, Ainv)), decimals=2)
+        recip_point_group = [inversion]
+        seen = {np.rint(inversion * 100).astype(np.int32).tobytes()}
+        for op, key in zip(candidates, keys):
+            key = key.tobytes()
+            if key not in seen:
                 recip_point_group.append(op)
-            if new_coset:
-                recip_point_group.append(np.dot(R, op))
+                seen.add(key)
 
-        return recip_point_group
+        for op in recip_point_group:
+            op.flags.writeable = False
+
+        return tuple(recip_point_group)
 
     @staticmethod
-    def _is_permutation_eq(A, B):
+    def _get_sorted_point_codes(pts):
         """
-        Check for equivalency between two arrays including permutations. 
+        Encode sets of points so that permutations of the same set compare equal. 
+
+        Args:
+          pts (np.ndarray): Points in fractional coordinates in [0, 1), shape 
+          (..., npts, 3).
 
         Returns:
-          Whether the two arrays are equivalent (True) or not (False). 
+          codes (np.ndarray): Sorted integer code of each point (coordinates in 
+          units of 0.001), shape (..., npts).
 
         """
-        count = {}
-        for a in A:
-            count[str(a)] = 1
+        ipts = np.rint(np.asarray(pts) * 1000).astype(np.int64)
+        codes = (ipts[..., 0] * 1001 + ipts[..., 1]) * 1001 + ipts[..., 2]
 
-        for b in B:
-            if str(b) in count:
-                if count[str(b)] == 0:
-                    return False
-                else:
-                    count[str(b)] = count[str(b)] - 1
-            else:
-                return False
-
-        return True
+        return np.sort(codes, axis=-1)
 
     def get_equiv_planes(self):
         """
@@ -249,35 +302,44 @@ class Z2PackWF:
           plane_equiv (dict): Dictionary providing equivalent TRIM plane names. 
 
         """
-        struct = self.structure
-        rpg_ops = Z2PackWF._get_reciprocal_point_group_nonmagnetic(struct)
-
-        trim_pts = list(itertools.product((0.0, 0.5), repeat=3))
-
-        planes = {}
-        plane_equiv = {}
-        symbols = ["x", "y", "z"]
-        for coord in range(3):
-            for plane_num in range(2):
-                planes["k%s_%s" % (symbols[coord], str(plane_num))] = [
-                    np.array(pt)
-                    for pt in trim_pts
-                    if pt[coord] == float(plane_num) / 2.0
-                ]
-                plane_equiv["k%s_%s" % (symbols[coord], str(plane_num))] = []
-
-        for plane in planes.keys():
-            for op in rpg_ops:
-                trans_pts = [np.dot(op, pt) % 1.0 for pt in planes[plane]]
-
-                for other_plane in planes.keys():
-                    if other_plane != plane:
-                        check_eq = Z2PackWF._is_permutation_eq(
-                            planes[other_plane], trans_pts
-                        )
-
-                        if check_eq and other_plane not in plane_equiv[plane]:
-                            plane_equiv[plane].append(other_plane)
+        plane_equiv = Z2PackWF._cached_equiv_planes(_StructureKey(self.structure))
+
+        return {plane: list(equiv) for plane, equiv in plane_equiv.items()}
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _cached_equiv_planes(struct_key):
+        """
+        Equivalent TRIM planes of struct_key.structure, cached per fingerprint.
+
+        Args:
+          struct_key (_StructureKey): Hashable wrapper of the input structure.
+
+        Returns:
+          plane_equiv (dict): Dictionary providing equivalent TRIM plane names. 
+
+        """
+        rpg_ops = Z2PackWF._cached_reciprocal_point_group(struct_key)
+
+        plane_equiv = {plane: [] for plane in TRIM_PLANE_NAMES}
+
+        # Apply every op to every TRIM point at once as one batched matmul
+        ops = np.stack(rpg_ops)
+        trans_planes = TRIM_PLANES.reshape(-1, 3) @ ops.transpose(0, 2, 1) % 1.0
+        trans_planes = trans_planes.reshape((len(ops),) + TRIM_PLANES.shape)
+
+        # check_eq[n, p, q]: op n maps plane p onto plane q
+        trans_codes = Z2PackWF._get_sorted_point_codes(trans_planes)
+        plane_codes = Z2PackWF._get_sorted_point_codes(TRIM_PLANES)
+        check_eq = np.all(
+            trans_codes[:, :, None, :] == plane_codes[None, None, :, :], axis=-1
+        )
+
+        for p, plane in enumerate(TRIM_PLANE_NAMES):
+            for n, q in np.argwhere(check_eq[:, p]):
+                other_plane = TRIM_PLANE_NAMES[q]
+                if other_plane != plane and other_plane not in plane_equiv[plane]:
+                    plane_equiv[plane].append(other_plane)
 
         return plane_equiv
 
@@ -285,6 +347,20 @@ class Z2PackWF:
         """
         Get the workflow.
 
+        The Z2Pack surface FWs only depend on the static FW and are joined by 
+        the InvariantFW, so they can run concurrently, e.g. with 
+        "rlaunch multi <nsurfaces>" on one node or "qlaunch rapidfire -m <nsurfaces>" 
+        on a cluster. Each surface calc is run with NCORE = 1, so size the 
+        per-FW resources to the share of the node that surface should use.
+
+        Args:
+          c (dict): Workflow config dict. Besides the usual atomate keys, 
+          accepts Z2PACK_CATEGORY (str) to restrict the surface FWs to fworkers 
+          of that category, Z2PACK_PRIORITY (int) for their FireWorks priority 
+          and Z2PACK_QUEUEADAPTER (dict, e.g. {"nodes": 1, "walltime": "24:00:00"}) 
+          to override the queue settings of each surface FW. Each is only set 
+          in the FW spec when given.
+
         Returns:
           Workflow
 
@@ -317,10 +393,10 @@ class Z2PackWF:
         # Run Z2Pack on unique TRIM planes in the BZ
 
         surfaces = ["kx_0", "kx_1"]
-        equiv_planes = self.get_equiv_planes()
 
         # Only run calcs on inequivalent BZ surfaces
         if self.symmetry_reduction:
+            equiv_planes = self.get_equiv_planes()
             for add_surface in equiv_planes.keys():
                 mark = True
                 for surface in surfaces:
@@ -329,7 +405,19 @@ class Z2PackWF:
                 if mark and add_surface not in surfaces:
                     surfaces.append(add_surface)
         else:
-            surfaces = ["kx_0", "kx_1", "ky_0", "ky_1", "kz_0", "kz_1"]
+            # No symmetry analysis needed when every surface is computed
+            equiv_planes = {plane: [] for plane in TRIM_PLANE_NAMES}
+            surfaces = list(TRIM_PLANE_NAMES)
+
+        # Surface FWs are independent of each other; optionally tag them so
+        # they can be pulled by dedicated workers and launched concurrently
+        z2pack_spec = {}
+        if c.get("Z2PACK_CATEGORY"):
+            z2pack_spec["_category"] = c["Z2PACK_CATEGORY"]
+        if c.get("Z2PACK_PRIORITY") is not None:
+            z2pack_spec["_priority"] = c["Z2PACK_PRIORITY"]
+        if c.get("Z2PACK_QUEUEADAPTER"):
+            z2pack_spec["_queueadapter"] = c["Z2PACK_QUEUEADAPTER"]
 
         z2pack_fws = []
 
@@ -342,6 +430,7 @@ class Z2PackWF:
                 name="z2pack",
                 vasp_cmd=c["VASP_CMD"],
                 db_file=c["DB_FILE"],
+                spec=dict(z2pack_spec),
             )
             z2pack_fws.append(z2pack_fw)
 
@@ -360,69 +449,34 @@ class Z2PackWF:
         wf = Workflow(fws)
         wf = add_additional_fields_to_taskdocs(wf, {"wf_meta": self.wf_meta})
 
+        # Collect INCAR updates per fw_name_constraint and apply each set once
+        incar_updates = defaultdict(dict)
+        incar_updates["structure optimization"].update(
+            {"EDIFFG": 0.005, "IBRION": 2, "NSW": 100}
+        )
+
         # Add vdW corrections if structure is layered
         dim_data = StructureDimensionality(self.structure)
 
-        if np.any(
-            [
-                dim == 2
-                for dim in [dim_data.larsen_dim, dim_data.cheon_dim, dim_data.gorai_dim]
-            ]
-        ):
-            wf = add_modify_incar(
-                wf,
-                modify_incar_params={
-                    "incar_update": {
-                        "IVDW": 11,
-                        "EDIFFG": 0.005,
-                        "IBRION": 2,
-                        "NSW": 100,
-                    }
-                },
-                fw_name_constraint="structure optimization",
-            )
+        if 2 in (dim_data.larsen_dim, dim_data.cheon_dim, dim_data.gorai_dim):
+            for fw_name_constraint in ["structure optimization", "static", "z2pack"]:
+                incar_updates[fw_name_constraint]["IVDW"] = 11
 
-            wf = add_modify_incar(
-                wf,
-                modify_incar_params={"incar_update": {"IVDW": 11}},
-                fw_name_constraint="static",
-            )
+        # Helpful vasp settings and no parallelization
+        incar_updates[None].update(
+            {"ADDGRID": ".TRUE.", "LASPH": ".TRUE.", "GGA": "PS", "NCORE": 1}
+        )
 
-            wf = add_modify_incar(
-                wf,
-                modify_incar_params={"incar_update": {"IVDW": 11}},
-                fw_name_constraint="z2pack",
-            )
+        # Generate inputs for Z2Pack with a static calc
+        incar_updates["static"]["PREC"] = "Accurate"
 
-        else:
+        for fw_name_constraint, incar_update in incar_updates.items():
             wf = add_modify_incar(
                 wf,
-                modify_incar_params={
-                    "incar_update": {"EDIFFG": 0.005, "IBRION": 2, "NSW": 100}
-                },
-                fw_name_constraint="structure optimization",
+                modify_incar_params={"incar_update": incar_update},
+                fw_name_constraint=fw_name_constraint,
             )
 
-        # Helpful vasp settings and no parallelization
-        wf = add_modify_incar(
-            wf,
-            modify_incar_params={
-                "incar_update": {
-                    "ADDGRID": ".TRUE.",
-                    "LASPH": ".TRUE.",
-                    "GGA": "PS",
-                    "NCORE": 1,
-                }
-            },
-        )
-
-        # Generate inputs for Z2Pack with a static calc
-        wf = add_modify_incar(
-            wf,
-            modify_incar_params={"incar_update": {"PREC": "Accurate"}},
-            fw_name_constraint="static",
-        )
-
         wf = add_common_powerups(wf, c)
 
         wf.name = "{} {}".format(self.structure.composition.reduced_formula, "Z2Pack")
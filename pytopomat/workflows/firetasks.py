@@ -4,12 +4,19 @@ import os
 import gzip
 import re
 
+from collections import defaultdict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from monty.json import MontyEncoder, jsanitize
 
 from pymatgen.core.structure import Structure
 from pymatgen.io.vasp import Incar
 
-from pytopomat.analyzer import Vasp2TraceCaller, Vasp2TraceOutput
+from pytopomat.analyzer import Vasp2TraceCaller
 from pytopomat.z2pack_caller import Z2PackCaller, Z2Output
 
 from fireworks import explicit_serialize, FiretaskBase, FWAction
@@ -26,6 +33,27 @@ from atomate.common.firetasks.glue_tasks import (
 
 logger = get_logger(__name__)
 
+GUNZIP_BUFSIZE = 8 * 1024 * 1024  # bytes per read/write when unzipping outputs
+
+_RELAX_RE = re.compile(r"\.relax\d*")
+
+
+def _dump_json(d, filename):
+    """
+    Write d to filename as compact JSON, using orjson if it is installed.
+
+    numpy scalars (e.g. np.float64 left in by jsanitize) are serialized as
+    numbers on both paths; orjson would otherwise pass them to
+    DATETIME_HANDLER and write null.
+    """
+    if orjson:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        with open(filename, "wb") as f:
+            f.write(orjson.dumps(d, default=DATETIME_HANDLER, option=option))
+    else:
+        with open(filename, "w") as f:
+            f.write(json.dumps(d, default=DATETIME_HANDLER, separators=(",", ":")))
+
 
 @explicit_serialize
 class Vasp2TraceToDb(FiretaskBase):
@@ -54,8 +82,7 @@ class Vasp2TraceToDb(FiretaskBase):
         # store the results
         db_file = env_chk(self.get("db_file"), fw_spec)
         if not db_file:
-            with open("vasp2trace.json", "w") as f:
-                f.write(json.dumps(d, default=DATETIME_HANDLER))
+            _dump_json(d, "vasp2trace.json")
         else:
             db = VaspCalcDb.from_db_file(db_file, admin=True)
             db.collection = db.db["vasp2trace"]
@@ -74,7 +101,7 @@ class RunVasp2Trace(FiretaskBase):
     def run_task(self, fw_spec):
 
         wd = os.getcwd()
-        Vasp2TraceCaller(wd)
+        v2tc = Vasp2TraceCaller(wd)
 
         try:
             raw_struct = Structure.from_file(wd + "/POSCAR")
@@ -82,10 +109,17 @@ class RunVasp2Trace(FiretaskBase):
             structure = raw_struct.as_dict()
 
         except:
-            composition = None
+            formula = None
             structure = None
 
-        data = Vasp2TraceOutput(wd + "/trace.txt")
+        # The caller has already parsed trace.txt; spin-polarized output
+        # (trace_up.txt / trace_dn.txt) is not supported here
+        if "down" in v2tc.output:
+            raise FileNotFoundError(
+                "Expected trace.txt but vasp2trace wrote spin-polarized "
+                "trace_up.txt and trace_dn.txt in {}.".format(wd)
+            )
+        data = v2tc.output["up"]
 
         return FWAction(
             update_spec={
@@ -173,7 +207,16 @@ class CopyVaspOutputs(CopyFiles):
         self.copy_files()
 
     def copy_files(self):
-        all_files = self.fileclient.listdir(self.from_dir)
+        all_files = set(self.fileclient.listdir(self.from_dir))
+
+        # group ".relax*" outputs by the file they belong to so no glob (an
+        # ssh round trip on remote filesystems) is needed per file
+        relax_files = defaultdict(list)
+        for fname in all_files:
+            m = _RELAX_RE.search(fname)
+            if m:
+                relax_files[fname[: m.start()]].append(fname)
+
         # start file copy
         for f in self.files_to_copy:
             prev_path_full = os.path.join(self.from_dir, f)
@@ -185,13 +228,13 @@ class CopyVaspOutputs(CopyFiles):
             dest_path = os.path.join(self.to_dir, dest_fname)
 
             relax_ext = ""
-            relax_paths = sorted(self.fileclient.glob(prev_path_full + ".relax*"))
+            relax_paths = sorted(relax_files.get(f, []))
             if relax_paths:
                 if len(relax_paths) > 9:
                     raise ValueError(
                         "CopyVaspOutputs doesn't properly handle >9 relaxations!"
                     )
-                m = re.search("\.relax\d*", relax_paths[-1])
+                m = _RELAX_RE.search(relax_paths[-1])
                 relax_ext = m.group(0)
 
             # detect .gz extension if needed - note that monty zpath() did not seem useful here
@@ -204,6 +247,12 @@ class CopyVaspOutputs(CopyFiles):
             if not (f + relax_ext + gz_ext) in all_files:
                 raise ValueError("Cannot find file: {}".format(f))
 
+            if gz_ext in [".gz", ".GZ"] and not self.fileclient.ssh:
+                # local source: unzip straight into the destination rather than
+                # copying the archive first and unzipping the copy
+                _gunzip(prev_path_full + relax_ext + gz_ext, dest_path)
+                continue
+
             # copy the file (minus the relaxation extension)
             self.fileclient.copy(
                 prev_path_full + relax_ext + gz_ext, dest_path + gz_ext
@@ -212,20 +261,23 @@ class CopyVaspOutputs(CopyFiles):
             # unzip the .gz if needed
             if gz_ext in [".gz", ".GZ"]:
                 # unzip dest file
-                if "WAVECAR" in dest_path:
-                    f = gzip.open(dest_path + gz_ext, "rb")
-                    with open(dest_path, "wb") as f_out:
-                        shutil.copyfileobj(f, f_out)
-                    f.close()
-                else:
-                    f = gzip.open(dest_path + gz_ext, "rt")
-                    file_content = f.read()
-                    with open(dest_path, "w") as f_out:
-                        f_out.writelines(file_content)
-                    f.close()
+                _gunzip(dest_path + gz_ext, dest_path)
                 os.remove(dest_path + gz_ext)
 
 
+def _gunzip(src_path, dest_path):
+    """
+    Decompress the gzipped file at src_path to dest_path.
+
+    Files are streamed in binary mode with a large buffer so multi-GB
+    WAVECARs are written in few large chunks and text files skip decoding.
+    """
+    with gzip.open(src_path, "rb") as f, open(
+        dest_path, "wb", buffering=GUNZIP_BUFSIZE
+    ) as f_out:
+        shutil.copyfileobj(f, f_out, length=GUNZIP_BUFSIZE)
+
+
 @explicit_serialize
 class SetUpZ2Pack(FiretaskBase):
     """
@@ -360,8 +412,7 @@ class Z2PackToDb(FiretaskBase):
         # store the results
         db_file = env_chk(self.get("db_file"), fw_spec)
         if not db_file:
-            with open("z2pack.json", "w") as f:
-                f.write(json.dumps(d, default=DATETIME_HANDLER))
+            _dump_json(d, "z2pack.json")
         else:
             db = VaspCalcDb.from_db_file(db_file, admin=True)
             db.collection = db.db["z2pack"]